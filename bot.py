@@ -1,13 +1,20 @@
 import asyncio
+import json
+import shutil
 import subprocess
 import tempfile
 import os
+import shelve
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
+from typing import NamedTuple, Optional
+import httpx
 from telegram.error import TelegramError, TimedOut, BadRequest
 from telegram.request import HTTPXRequest
 
 
-from telegram import Update, Message
+from telegram import Update, Message, File
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -46,31 +53,639 @@ def load_bot_token() -> str:
 
 BOT_TOKEN = load_bot_token()
 
+# تنظیمات x264 (با env قابل تغییره)
+X264_PRESET = os.getenv("X264_PRESET", "veryfast")
+X264_CRF = os.getenv("X264_CRF", "27")
+
+# تعداد thread هایی که هر ffmpeg استفاده می‌کنه
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", os.cpu_count() or 4))
+
+# حداکثر تعداد ffmpeg هم‌زمان، که با چند تا کاربر سرور هنگ نکنه
+MAX_CONCURRENT_ENCODES = int(
+    os.getenv("MAX_CONCURRENT_ENCODES", max(1, (os.cpu_count() or 2) // 2))
+)
+ENCODE_SEM = asyncio.Semaphore(MAX_CONCURRENT_ENCODES)
+
+# دانلود موازی: تعداد تیکه‌ها (زیاد نکن، تلگرام flood wait میده)
+DOWNLOAD_PARTS = int(os.getenv("DOWNLOAD_PARTS", "4"))
+MIN_PARALLEL_DOWNLOAD = 4 * 1024 * 1024  # فایل‌های کوچیک‌تر از این رو یکجا بگیر
+
+# timeout ها (ثانیه)، مشترک بین PTB و کلاینت دانلود موازی
+CONNECT_TIMEOUT = 30   # زمان صبر برای وصل شدن به سرور تلگرام
+READ_TIMEOUT = 180     # زمان صبر برای دریافت جواب (اینو زیاد کن)
+WRITE_TIMEOUT = 180    # زمان صبر برای آپلود داده (ویدئو)
+POOL_TIMEOUT = 30
+
+# چند تا درخواست هم‌مدت که نزدیک هم میان رو با یک ffmpeg انکود کن
+# کل batch یک جا از ENCODE_SEM می‌گیره و FFMPEG_THREADS بین خروجی‌ها تقسیم می‌شه،
+# پس بار CPU هر جا همونه. پیش‌فرض خاموشه (1): با libx264 فقط هزینه‌ی اجرای
+# ffmpeg صرفه‌جویی می‌شه ولی هر درخواست BATCH_WINDOW صبر می‌کنه و رم بیشتری می‌خواد؛
+# با انکودر سخت‌افزاری (که باز کردن session گرونه) روشنش کن، مثلاً BATCH_MAX=4
+BATCH_MAX = max(1, int(os.getenv("BATCH_MAX", "1")))
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", "0.2"))  # ثانیه
+BATCH_DURATION_RATIO = 1.5  # فقط ویدیوهایی که مدتشون حداکثر ۱.۵ برابر هم‌دیگه‌ست
+
+# فایل‌های موقت روی /dev/shm (رم) که دیسک کند سرور گلوگاه نشه
+SHM_DIR = "/dev/shm"
+
+# سقف حجم خروجی (MB) که آپلود به تلگرام timeout نخوره
+TARGET_SIZE_MB = 45
+AUDIO_KBPS = 96  # بیت‌ریت aac وقتی صدا رو دوباره انکود می‌کنیم
+
+# ویدیوهای H.264 که از این کوچیک‌ترن رو اصلاً انکود نکن
+SKIP_MAX_MB = int(os.getenv("SKIP_MAX_MB", "10"))
+SKIP_MAX_KBPS = int(os.getenv("SKIP_MAX_KBPS", "1500"))
+
+
+# ---------- Cache: file_unique_id → compressed file_id ----------
+# اگه یه ویدیو قبلاً فشرده شده، دوباره دانلود و انکود نکن؛ file_id خروجی رو دوباره بفرست
+CACHE_PATH = Path(__file__).parent / "keys" / "cache.db"
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "1000"))
+
+
+def load_cache() -> OrderedDict:
+    """Load the LRU cache (oldest first) from the shelve file."""
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with shelve.open(str(CACHE_PATH)) as db:
+        return OrderedDict(db.get("items", []))
+
+
+CACHE = load_cache()
+
+
+def cache_get(unique_id: str) -> Optional[tuple]:
+    """Return (file_id, original_mb, compressed_mb) for a known video, or None."""
+    entry = CACHE.get(unique_id)
+    if entry is not None:
+        CACHE.move_to_end(unique_id)
+    return entry
+
+
+# فقط یک task روی دیسک می‌نویسه که snapshot قدیمی روی جدید ننشینه
+cache_dirty = False
+cache_writer: Optional[asyncio.Task] = None
+
+
+def save_cache(items: list) -> None:
+    """Write the cache to disk (blocking; run it in a worker thread)."""
+    with shelve.open(str(CACHE_PATH)) as db:
+        db["items"] = items
+
+
+async def cache_writer_loop() -> None:
+    """Keep writing the latest snapshot until no change is left unsaved."""
+    global cache_dirty
+    while cache_dirty:
+        cache_dirty = False
+        # نوشتن روی دیسک رو بفرست توی thread که event loop معطل نشه
+        await asyncio.to_thread(save_cache, list(CACHE.items()))
+
+
+def schedule_cache_save() -> None:
+    """Mark the cache dirty and make sure the single writer task is running."""
+    global cache_dirty, cache_writer
+    cache_dirty = True
+    if cache_writer is None or cache_writer.done():
+        cache_writer = asyncio.create_task(cache_writer_loop())
+
+
+def cache_put(unique_id: str, file_id: str, original_size: float, compressed_size: float) -> None:
+    """Store a compressed result, evict the least recently used ones and persist."""
+    CACHE[unique_id] = (file_id, original_size, compressed_size)
+    CACHE.move_to_end(unique_id)
+    while len(CACHE) > CACHE_MAX_ITEMS:
+        CACHE.popitem(last=False)
+    schedule_cache_save()
+
+
+def cache_drop(unique_id: str) -> None:
+    """Forget a cached result (e.g. its file_id is no longer usable) and persist."""
+    if CACHE.pop(unique_id, None) is not None:
+        schedule_cache_save()
+
+
+# ---------- ffmpeg / ffprobe binaries ----------
+def find_binary(name: str) -> str:
+    """Resolve a binary on PATH once at startup, fail fast if it is missing."""
+    path = shutil.which(name)
+    if path is None:
+        raise RuntimeError(f"{name} not found in PATH! Install ffmpeg first.")
+    return path
+
+
+FFMPEG = find_binary("ffmpeg")
+FFPROBE = find_binary("ffprobe")
+
+
+# ---------- Hardware encoder settings ----------
+HW_ENCODERS = ("h264_nvenc", "h264_vaapi", "h264_videotoolbox")
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+# بیت‌ریت هدف vaapi/videotoolbox وقتی سقف داریم (حدوداً هم‌اندازه‌ی crf 27 در 720p)
+HW_TARGET_KBPS = int(os.getenv("HW_TARGET_KBPS", "2000"))
+
 
 # ---------- Utility: run ffmpeg to compress video ----------
-def compress_video(input_path: Path, output_path: Path) -> None:
+class EncodeJob(NamedTuple):
+    """One input → output encode and its per-file settings."""
+    input_path: Path
+    output_path: Path
+    max_kbps: Optional[int] = None
+    scale: bool = True
+    copy_audio: bool = False
+    duration: Optional[float] = None
+
+
+def build_ffmpeg_cmd(jobs: list, encoder: Optional[str]) -> list:
+    """
+    Build one ffmpeg argv that encodes every EncodeJob in `jobs`
+    with the given video encoder (None → libx264).
+
+    Each job is its own `-i` input and its own output with explicit `-map`,
+    so per-file options (bitrate cap, scale, audio copy) stay independent.
+    FFMPEG_THREADS is split between the outputs.
+
+    If a hardware encoder was found at startup (HW_ENCODER) it is passed
+    here; encode_jobs retries with libx264 (encoder=None) if it fails.
+    """
+    cmd = [FFMPEG, "-y"]
+    threads = max(1, FFMPEG_THREADS // len(jobs))
+
+    if encoder == "h264_vaapi":
+        cmd += ["-vaapi_device", VAAPI_DEVICE]
+
+    for job in jobs:
+        cmd += ["-fflags", "+fastseek", "-i", str(job.input_path)]
+
+    for i, job in enumerate(jobs):
+        cmd += ["-map", f"{i}:v:0", "-map", f"{i}:a:0?"]
+        cmd += output_args(job, encoder, threads)
+    return cmd
+
+
+def hw_rate_args(max_kbps: int, rate_cap: list) -> list:
+    """Bitrate args for vaapi/videotoolbox: HW_TARGET_KBPS target, max_kbps only as the ceiling."""
+    return ["-b:v", f"{min(max_kbps, HW_TARGET_KBPS)}k", *rate_cap]
+
+
+def output_args(job: EncodeJob, encoder: Optional[str], threads: int = FFMPEG_THREADS) -> list:
     """
-    Run ffmpeg to compress a video.
+    ffmpeg output options for one job.
 
-    - scale=-2:720   → keep aspect ratio, max height = 720
+    - scale=-2:720   → keep aspect ratio, max height = 720 (skipped if job.scale is False)
     - libx264        → common H.264 codec
-    - -crf 28        → quality factor (higher = more compression, lower quality)
+    - -crf 27        → quality factor (higher = more compression, lower quality)
     - veryfast       → faster encoding( faster means less compression)
-    - aac            → audio codec
+    - aac            → audio codec (stream-copied if job.copy_audio, i.e. already AAC)
+    - -threads N     → use `threads` cores instead of x264's guess
+    - +faststart     → moov atom at the start, so Telegram can stream it right away
+    - max_kbps       → optional -maxrate cap (see target_video_kbps) so the
+                       result fits under TARGET_SIZE_MB in a single pass
+
+    preset / crf can be overridden with X264_PRESET / X264_CRF env variables.
     """
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-i", str(input_path),
-        "-vf", "scale=-2:720",
-        "-c:v", "libx264",
-        "-crf", "29",
-        "-preset", "slow",
-        "-c:a", "aac",
-
-        str(output_path),
+    max_kbps, scale, copy_audio = job.max_kbps, job.scale, job.copy_audio
+    cmd = []
+    scale_vf = ["-vf", "scale=-2:720"] if scale else []
+    rate_cap = []
+    if max_kbps is not None:
+        rate_cap = ["-maxrate", f"{max_kbps}k", "-bufsize", f"{max_kbps * 2}k"]
+
+    if encoder == "h264_nvenc":
+        cmd += [
+            *scale_vf,
+            "-c:v", "h264_nvenc",
+            "-preset", "p4",
+            "-rc", "vbr",
+            "-cq", "28",
+            "-b:v", "0",
+            *rate_cap,
+        ]
+    elif encoder == "h264_vaapi":
+        cmd += [
+            "-vf", "format=nv12,hwupload" + (",scale_vaapi=-2:720" if scale else ""),
+            "-c:v", "h264_vaapi",
+        ]
+        # vaapi با qp ثابت سقف بیت‌ریت رو رعایت نمی‌کنه؛ پس با سقف می‌ریم سراغ
+        # بیت‌ریت معمولی و max_kbps فقط سقفه، نه هدف (وگرنه کلیپ کوتاه بزرگ‌تر می‌شه)
+        cmd += hw_rate_args(max_kbps, rate_cap) if max_kbps else ["-qp", "28"]
+    elif encoder == "h264_videotoolbox":
+        cmd += [
+            *scale_vf,
+            "-c:v", "h264_videotoolbox",
+        ]
+        cmd += hw_rate_args(max_kbps, rate_cap) if max_kbps else ["-q:v", "55"]
+    else:
+        cmd += [
+            *scale_vf,
+            "-c:v", "libx264",
+            "-crf", X264_CRF,
+            "-preset", X264_PRESET,
+            "-threads", str(threads),
+            "-x264-params",
+            f"threads={threads}:sliced-threads=0:lookahead-threads={max(1, threads // 4)}",
+            *rate_cap,
+        ]
+
+    cmd += [
+        *(["-c:a", "copy"] if copy_audio else ["-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k"]),
+        "-avoid_negative_ts", "make_zero",
+        "-movflags", "+faststart",
+        str(job.output_path),
     ]
-    subprocess.run(cmd, check=True)
+    return cmd
+
+
+# ---------- Hardware encoder detection ----------
+def hw_encoder_works(encoder: str) -> bool:
+    """
+    Try a one-frame test encode with the exact output options real jobs use
+    (with and without a bitrate cap): being listed by `ffmpeg -encoders`
+    only means it was compiled in (stock Debian/Ubuntu ffmpeg lists nvenc
+    even on machines without an NVIDIA GPU), and an older ffmpeg may lack
+    some of the flags.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for max_kbps in (None, 1000):
+            job = EncodeJob(Path("nullsrc"), Path(tmpdir) / "probe.mp4", max_kbps)
+            cmd = [FFMPEG, "-y", "-hide_banner", "-v", "error"]
+            if encoder == "h264_vaapi":
+                cmd += ["-vaapi_device", VAAPI_DEVICE]
+            cmd += ["-f", "lavfi", "-i", "nullsrc=s=640x360", "-frames:v", "1"]
+            cmd += output_args(job, encoder)
+            try:
+                subprocess.run(cmd, capture_output=True, check=True, timeout=30)
+            except (OSError, subprocess.SubprocessError):
+                return False
+    return True
+
+
+def detect_hw_encoder() -> Optional[str]:
+    """
+    Run `ffmpeg -encoders` once at startup and return the first hardware
+    H.264 encoder that passes a test encode, or None to use libx264.
+
+    HW_ENCODER env: "auto" (default), "none", or an encoder name to force.
+    """
+    choice = os.getenv("HW_ENCODER", "auto")
+    if choice == "none":
+        return None
+
+    try:
+        result = subprocess.run(
+            [FFMPEG, "-hide_banner", "-encoders"],
+            capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    candidates = HW_ENCODERS if choice == "auto" else (choice,)
+    for encoder in candidates:
+        if encoder not in result.stdout:
+            continue
+        # vaapi بدون دیوایس کار نمی‌کنه
+        if encoder == "h264_vaapi" and not os.path.exists(VAAPI_DEVICE):
+            continue
+        if not hw_encoder_works(encoder):
+            print(f"{encoder} is listed but the test encode failed, skipping it")
+            continue
+        return encoder
+    return None
+
+
+HW_ENCODER = detect_hw_encoder()
+
+
+async def run_ffmpeg(cmd: list) -> None:
+    """Run an ffmpeg command without blocking the event loop."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, err = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=err)
+
+
+async def probe_video(path: Path) -> dict:
+    """
+    Run ffprobe once and return what we need about the file:
+    {"duration": float | None, "height": int | None,
+     "codec": str | None, "kbps": int | None,
+     "audio_codec": str | None, "audio_kbps": int | None}
+    """
+    proc = await asyncio.create_subprocess_exec(
+        FFPROBE,
+        "-v", "error",
+        "-show_entries", "format=duration,bit_rate:stream=codec_type,codec_name,height,bit_rate",
+        "-of", "json",
+        str(path),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    out, _ = await proc.communicate()
+    try:
+        data = json.loads(out or b"{}")
+    except ValueError:
+        data = {}
+
+    fmt = data.get("format") or {}
+    video = next(
+        (st for st in data.get("streams") or [] if st.get("codec_type") == "video"),
+        {},
+    )
+    audio = next(
+        (st for st in data.get("streams") or [] if st.get("codec_type") == "audio"),
+        {},
+    )
+
+    info = {
+        "duration": None,
+        "height": video.get("height"),
+        "codec": video.get("codec_name"),
+        "kbps": None,
+        "audio_codec": audio.get("codec_name"),
+        "audio_kbps": None,
+    }
+    try:
+        info["duration"] = float(fmt["duration"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    # بیت‌ریت خود استریم ویدیو، اگه نبود بیت‌ریت کل فایل
+    try:
+        info["kbps"] = int(video.get("bit_rate") or fmt["bit_rate"]) // 1000
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        info["audio_kbps"] = int(audio["bit_rate"]) // 1000
+    except (KeyError, TypeError, ValueError):
+        pass
+    return info
+
+
+def already_compact(info: dict, size: int) -> bool:
+    """
+    True if re-encoding is pointless: the file is H.264 and either small
+    (≤ SKIP_MAX_MB) or already ≤ 720p at a modest bitrate (≤ SKIP_MAX_KBPS).
+    """
+    if info["codec"] != "h264":
+        return False
+    if size <= SKIP_MAX_MB * 1024 * 1024:
+        return True
+    return (
+        info["height"] is not None and info["height"] <= 720
+        and info["kbps"] is not None and info["kbps"] <= SKIP_MAX_KBPS
+    )
+
+
+def target_video_kbps(duration: Optional[float], audio_kbps: int = AUDIO_KBPS) -> Optional[int]:
+    """Video bitrate (kbps) that keeps a `duration`-second clip under TARGET_SIZE_MB."""
+    if not duration or duration <= 0:
+        return None
+    total_kbps = TARGET_SIZE_MB * 1024 * 8 / duration * 0.92
+    return max(100, int(total_kbps - audio_kbps))
+
+
+async def encode_jobs(jobs: list) -> None:
+    """
+    Encode `jobs` in one ffmpeg run, hardware encoder first, then libx264.
+    ffmpeg is started with asyncio so the event loop stays free while encoding.
+    """
+    if HW_ENCODER is not None:
+        try:
+            await run_ffmpeg(build_ffmpeg_cmd(jobs, HW_ENCODER))
+            return
+        except subprocess.CalledProcessError as e:
+            print(
+                f"{HW_ENCODER} failed, falling back to libx264:",
+                e.stderr.decode(errors="replace")[-500:],
+            )
+
+    await run_ffmpeg(build_ffmpeg_cmd(jobs, None))
+
+
+# ---------- Batching: several requests → one ffmpeg ----------
+# هر آیتم: (job, started_event, done_future)
+PENDING: list = []
+BATCH_FULL = asyncio.Event()
+batch_task: Optional[asyncio.Task] = None
+
+
+def submit_encode(job: EncodeJob) -> tuple:
+    """
+    Queue a job for the batch worker.
+
+    Returns (started, done): `started` is set once the job's batch has an
+    encode slot, `done` resolves when it is encoded (or holds the error).
+    """
+    global batch_task
+    started = asyncio.Event()
+    done = asyncio.get_running_loop().create_future()
+    PENDING.append((job, started, done))
+    if len(PENDING) >= BATCH_MAX:
+        BATCH_FULL.set()
+    if batch_task is None or batch_task.done():
+        batch_task = asyncio.create_task(batch_worker())
+    return started, done
+
+
+def similar_duration(a: EncodeJob, b: EncodeJob) -> bool:
+    """True if both clips have a known duration within BATCH_DURATION_RATIO of each other."""
+    if not a.duration or not b.duration:
+        return False
+    return max(a.duration, b.duration) <= min(a.duration, b.duration) * BATCH_DURATION_RATIO
+
+
+def take_batch() -> list:
+    """
+    Pop the oldest pending job plus up to BATCH_MAX - 1 others of similar
+    duration, so a short clip never waits for a long one to finish.
+    """
+    first = PENDING.pop(0)
+    batch = [first]
+    for item in list(PENDING):
+        if len(batch) >= BATCH_MAX:
+            break
+        if similar_duration(first[0], item[0]):
+            PENDING.remove(item)
+            batch.append(item)
+    return batch
+
+
+async def batch_worker() -> None:
+    """Collect pending jobs for up to BATCH_WINDOW seconds (or BATCH_MAX jobs) and run them."""
+    while PENDING:
+        if BATCH_MAX > 1:
+            try:
+                await asyncio.wait_for(BATCH_FULL.wait(), BATCH_WINDOW)
+            except asyncio.TimeoutError:
+                pass
+        BATCH_FULL.clear()
+        while PENDING:
+            asyncio.create_task(run_batch(take_batch()))
+
+
+async def run_batch(batch: list) -> None:
+    """
+    Encode a batch in one ENCODE_SEM slot (build_ffmpeg_cmd splits
+    FFMPEG_THREADS between the outputs). If the shared ffmpeg run fails
+    (one bad file breaks all outputs), retry the jobs one by one so only
+    the bad one fails.
+    """
+    try:
+        async with ENCODE_SEM:
+            for _, started, _ in batch:
+                started.set()
+
+            jobs = [job for job, _, _ in batch]
+            try:
+                await encode_jobs(jobs)
+                results = [None] * len(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    results = [e]
+                else:
+                    results = []
+                    for job in jobs:
+                        try:
+                            await encode_jobs([job])
+                            results.append(None)
+                        except Exception as job_error:
+                            results.append(job_error)
+    except asyncio.CancelledError:
+        # منتظرها رو بی‌جواب نذار
+        for _, _, done in batch:
+            done.cancel()
+        raise
+
+    for (_, _, done), result in zip(batch, results):
+        if isinstance(result, BaseException):
+            done.set_exception(result)
+        else:
+            done.set_result(None)
+
+
+# بایت‌هایی که کارهای در حال اجرا روی /dev/shm رزرو کردن
+shm_reserved = 0
+
+
+@contextmanager
+def scratch_dir(file_size: Optional[int]):
+    """
+    Pick where to put temp files: /dev/shm (tmpfs) if it exists and has room
+    for the input plus the output after what other jobs have reserved,
+    otherwise None (the default /tmp). The reservation is held until exit.
+    """
+    global shm_reserved
+    needed = (file_size or 0) * 3
+    if (
+        not file_size
+        or not os.path.isdir(SHM_DIR)
+        or shutil.disk_usage(SHM_DIR).free - shm_reserved < needed
+    ):
+        yield None
+        return
+
+    shm_reserved += needed
+    try:
+        yield SHM_DIR
+    finally:
+        shm_reserved -= needed
+
+
+# ---------- Utility: download file from Telegram ----------
+# کلاینت مشترک دانلود موازی؛ توی post_init ساخته و توی post_shutdown بسته می‌شه
+download_client: Optional[httpx.AsyncClient] = None
+
+
+def preallocate(path: Path, size: int) -> None:
+    """Create `path` with `size` bytes reserved (blocking; run it in a worker thread)."""
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+
+def write_at(path: Path, offset: int, chunks: list) -> None:
+    """Write `chunks` into `path` starting at `offset` (blocking; run it in a worker thread)."""
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        for chunk in chunks:
+            f.write(chunk)
+
+
+async def download_file(file_obj: File, path: Path) -> None:
+    """
+    Download a Telegram file to `path`.
+
+    Big files are fetched as DOWNLOAD_PARTS parallel HTTP Range requests,
+    each part streamed and written at its own offset. If the file is small,
+    has no http URL (local Bot API server) or the server ignores Range, we
+    fall back to the normal single-stream download_to_drive.
+    """
+    size = file_obj.file_size
+    url = file_obj.file_path
+    if (
+        download_client is None
+        or not size
+        or size < MIN_PARALLEL_DOWNLOAD
+        or DOWNLOAD_PARTS < 2
+        or not url
+        or not url.startswith("http")
+    ):
+        await file_obj.download_to_drive(custom_path=path)
+        return
+
+    part_size = -(-size // DOWNLOAD_PARTS)  # ceil
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+    async def write_part(offset: int, chunks: list) -> None:
+        # اگه task کنسل شد، صبر کن نوشتن thread تموم بشه؛ وگرنه وسط دانلود جایگزین روی فایل می‌نویسه
+        write = asyncio.ensure_future(asyncio.to_thread(write_at, path, offset, chunks))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            await asyncio.gather(write, return_exceptions=True)
+            raise
+
+    async def fetch_part(start: int, end: int) -> None:
+        offset = start
+        async with download_client.stream(
+            "GET", url, headers={"Range": f"bytes={start}-{end}"}
+        ) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise httpx.HTTPError("server ignored Range header")
+            # تیکه‌تیکه بنویس که کل part توی رم نمونه و نوشتن event loop رو قفل نکنه
+            buffered, buffered_size = [], 0
+            async for chunk in resp.aiter_bytes():
+                buffered.append(chunk)
+                buffered_size += len(chunk)
+                if buffered_size >= 1024 * 1024:
+                    await write_part(offset, buffered)
+                    offset += buffered_size
+                    buffered, buffered_size = [], 0
+            if buffered:
+                await write_part(offset, buffered)
+
+    tasks = []
+    try:
+        try:
+            # جا رو از قبل رزرو کن که هر تیکه سر offset خودش نوشته بشه
+            await asyncio.to_thread(preallocate, path, size)
+            tasks = [asyncio.create_task(fetch_part(start, end)) for start, end in ranges]
+            await asyncio.gather(*tasks)
+        finally:
+            # اگه یک تیکه خطا داد (یا خودمون کنسل شدیم)، بقیه رو کنسل کن و صبر کن تموم بشن
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except (httpx.HTTPError, httpx.StreamError, OSError) as e:
+        # repr(e) آدرس رو داره و آدرس توکن ربات رو؛ فقط نوع خطا و status رو لاگ کن
+        status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+        print("parallel download failed, falling back:", type(e).__name__, status)
+        await file_obj.download_to_drive(custom_path=path)
 
 
 # ------------------------ Helpers--------------------------
@@ -102,6 +717,16 @@ async def delete_later(msg: Message, delay: int = 10):
     except TelegramError as e:
         print("delete_later failed:", repr(e))
 
+async def delete_messages(*msgs: Optional[Message]) -> None:
+    """Delete several messages concurrently (None entries are skipped)."""
+    results = await asyncio.gather(
+        *(m.delete() for m in msgs if m is not None),
+        return_exceptions=True,
+    )
+    for r in results:
+        if isinstance(r, TelegramError):
+            print("delete failed:", repr(r))
+
 # ---------- /start command ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
@@ -142,10 +767,39 @@ async def compress_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             "یا این‌که روی یک ویدیو Reply کنی و /compress رو بفرستی. 🙂"
         )
 
+        # هر دو رو بی‌معطلی بفرست، منتظر جواب تلگرام نمون
         asyncio.create_task(delete_later(file_not_found_msg, delay=10))
-        await message.delete()
+        asyncio.create_task(delete_messages(message))
         return
 
+    # اگه این ویدیو قبلاً فشرده شده، همون نسخه رو از سرور تلگرام بفرست
+    cached = cache_get(media_obj.file_unique_id)
+    if cached is not None:
+        cached_file_id, original_size, compressed_size = cached
+        try:
+            await source_msg.reply_video(
+                video=cached_file_id,
+                caption=(
+                    "🎬 این هم نسخه‌ی فشرده‌شده.\n"
+                    f"حجم قبلی: {original_size:.2f} MB\n"
+                    f"حجم جدید: {compressed_size:.2f} MB"
+                ),
+            )
+        except TimedOut:
+            err_msg = await message.reply_text(
+                "ارسال ویدیو طول کشید و timeout شد 😕 دوباره امتحان کن."
+            )
+            asyncio.create_task(delete_later(err_msg, delay=10))
+            await delete_messages(message)
+            return
+        except BadRequest as e:
+            # file_id کش دیگه به درد نمی‌خوره (مثلاً توکن عوض شده)؛ پاکش کن و از اول فشرده کن
+            print("cached file_id rejected, re-encoding:", repr(e))
+            cache_drop(media_obj.file_unique_id)
+        else:
+            await delete_messages(message)
+            return
+
     processing_msg = await message.reply_text("ویدیو رو گرفتم، دارم فشرده‌اش می‌کنم✅...")
 
 
@@ -153,25 +807,64 @@ async def compress_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     file_obj = await media_obj.get_file()
 
     # بقیه مثل قبل 👇
-    with tempfile.TemporaryDirectory() as tmpdir:
+    with scratch_dir(file_obj.file_size) as scratch, tempfile.TemporaryDirectory(dir=scratch) as tmpdir:
         tmpdir_path = Path(tmpdir)
         input_path = tmpdir_path / file_name
         output_path = tmpdir_path / f"compressed_{file_name}"
 
         # دانلود از سرور تلگرام
-        await file_obj.download_to_drive(custom_path=input_path)
+        await download_file(file_obj, input_path)
+        input_size = await asyncio.to_thread(os.path.getsize, input_path)
+
+        info = await probe_video(input_path)
+
+        # اگه ویدیو خودش به‌اندازه‌ی کافی جمع‌وجوره، همون رو بدون آپلود دوباره بفرست
+        # (فقط برای video؛ file_id یک document رو sendVideo قبول نمی‌کنه)
+        if source_msg.video is not None and already_compact(info, input_size):
+            try:
+                await source_msg.reply_video(
+                    video=media_obj.file_id,
+                    caption="🎬 این ویدیو خودش به‌اندازه‌ی کافی کم‌حجمه، نیازی به فشرده‌سازی نداشت.",
+                )
+            except BadRequest as e:
+                # نشد؟ عیبی نداره، مثل همیشه فشرده‌اش کن
+                print("reuse original failed, encoding instead:", repr(e))
+            else:
+                await delete_messages(processing_msg, message)
+                return
+
+        # صدای aac رو دوباره انکود نکن، فقط کپی کن
+        copy_audio = info["audio_codec"] == "aac"
+        audio_kbps = (info["audio_kbps"] or AUDIO_KBPS) if copy_audio else AUDIO_KBPS
+        # بیت‌ریت رو طوری محدود کن که خروجی زیر TARGET_SIZE_MB بمونه
+        max_kbps = target_video_kbps(info["duration"], audio_kbps)
+        # اگه ارتفاع ویدیو خودش ۷۲۰ یا کمتره، scale الکی نکن
+        scale = info["height"] is None or info["height"] > 720
+
+        # اگه ظرفیت پره، به کاربر بگو که توی صفه
+        queued = ENCODE_SEM.locked()
+        if queued:
+            await processing_msg.edit_text("در صف... ⏳ به‌زودی نوبتت میشه.")
 
-        # اجرای ffmpeg
+        # اجرای ffmpeg (ممکنه با درخواست‌های هم‌زمان دیگه توی یک ffmpeg انکود بشه)
+        started, done = submit_encode(
+            EncodeJob(input_path, output_path, max_kbps, scale, copy_audio, info["duration"])
+        )
         try:
-            compress_video(input_path, output_path)
+            if queued:
+                await started.wait()
+                await processing_msg.edit_text("ویدیو رو گرفتم، دارم فشرده‌اش می‌کنم✅...")
+            await done
         except subprocess.CalledProcessError:
             await message.reply_text("یک مشکلی در حین فشرده‌سازی پیش اومد.❌")
             return
 
-        original_size = input_path.stat().st_size / (1024 * 1024)
-        compressed_size = output_path.stat().st_size / (1024 * 1024)
+        original_size = input_size / (1024 * 1024)
+        # فایل ورودی دیگه لازم نیست، زودتر پاکش کن که موقع آپلود فقط یک فایل روی دیسک باشه
+        await asyncio.to_thread(input_path.unlink)
+        compressed_size = await asyncio.to_thread(os.path.getsize, output_path) / (1024 * 1024)
         #هشدار برای اینکه اگر حجمش زیاد هست انتظارشو داشته باشه که تایم اوت بخوره
-        if (compressed_size > 45):  # مثلا بیشتر از 45MB
+        if (compressed_size > TARGET_SIZE_MB):  # مثلا بیشتر از 45MB
             warning_msg = await message.reply_text(
                 f"حجم ویدیو بعد از فشرده‌سازی هنوز {compressed_size:.1f}MB است.\n"
                 "ممکنه روی این اینترنت timeout بخوره 🥲"
@@ -184,27 +877,31 @@ async def compress_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             )
             asyncio.create_task(delete_later(limit_erorr_msg, delay=10))
 
-            # تمیزکاری: حذف پیام‌های موقت
-            try:
-                await processing_msg.delete()
-                await message.delete()
-                if warning_msg is not None:
-                    await warning_msg.delete()
-            except TelegramError as e:
-                print("delete failed:", repr(e))
+            # تمیزکاری: حذف پیام‌های موقت (بدون منتظر موندن)
+            asyncio.create_task(delete_messages(processing_msg, message, warning_msg))
 
             return  # 👈 دیگه ادامه نده
 
         #ارسالی فایلی کاهش حجم داده شده
         try:
-            await source_msg.reply_video(
-                video=output_path.open("rb"),
+            # فایل رو توی یک thread بخون؛ PTB خودش فایل رو sync می‌خونه و event loop رو قفل می‌کنه
+            video_bytes = await asyncio.to_thread(output_path.read_bytes)
+            sent_msg = await source_msg.reply_video(
+                video=video_bytes,
+                filename=output_path.name,
                 caption=(
                     "🎬 این هم نسخه‌ی فشرده‌شده.\n"
                     f"حجم قبلی: {original_size:.2f} MB\n"
                     f"حجم جدید: {compressed_size:.2f} MB"
                 ),
             )
+            if sent_msg.video is not None:
+                cache_put(
+                    media_obj.file_unique_id,
+                    sent_msg.video.file_id,
+                    original_size,
+                    compressed_size,
+                )
         except TimedOut:
             # پیام خطا
             err_msg = await message.reply_text(
@@ -214,13 +911,7 @@ async def compress_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             asyncio.create_task(delete_later(err_msg, delay=10))
         finally:
             # این بلاک حتی اگر بالا error بده باز هم اجرا می‌شود
-            try:
-                await processing_msg.delete()
-                await message.delete()
-                if warning_msg is not None:
-                    await warning_msg.delete()
-            except TelegramError as e:
-                print("delete failed:", repr(e))
+            await delete_messages(processing_msg, message, warning_msg)
 
 
 
@@ -270,17 +961,56 @@ async def inspect_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # ---------- Main entry ----------
 def main() -> None:
+    # HTTP/2 فقط وقتی که پکیج h2 نصب باشه (pip install "httpx[http2]")
+    try:
+        import h2  # noqa: F401
+        http_version = "2"
+    except ImportError:
+        http_version = "1.1"
+
     request = HTTPXRequest(
-        connect_timeout=30,   # زمان صبر برای وصل شدن به سرور تلگرام
-        read_timeout=180,     # زمان صبر برای دریافت جواب (اینو زیاد کن)
-        write_timeout=180,    # زمان صبر برای آپلود داده (ویدئو)
-        pool_timeout=30,
+        connection_pool_size=64,  # چند تا کاربر هم‌زمان پشت یک pool کوچیک گیر نکنن
+        http_version=http_version,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        write_timeout=WRITE_TIMEOUT,
+        pool_timeout=POOL_TIMEOUT,
     )
 
+    # یک request جدا برای getUpdates که آپلودهای سنگین polling رو معطل نکنن
+    updates_request = HTTPXRequest(
+        http_version=http_version,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=60,
+        pool_timeout=POOL_TIMEOUT,
+    )
+
+    async def open_download_client(app) -> None:
+        # همون timeout ها؛ پروکسی هم مثل PTB از env (HTTPS_PROXY) خونده می‌شه
+        global download_client
+        download_client = httpx.AsyncClient(
+            http2=http_version == "2",
+            timeout=httpx.Timeout(
+                connect=CONNECT_TIMEOUT,
+                read=READ_TIMEOUT,
+                write=WRITE_TIMEOUT,
+                pool=POOL_TIMEOUT,
+            ),
+            limits=httpx.Limits(max_connections=64),
+        )
+
+    async def close_download_client(app) -> None:
+        if download_client is not None:
+            await download_client.aclose()
+
     app = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
         .request(request)
+        .get_updates_request(updates_request)
+        .concurrent_updates(True)  # هر آپدیت توی task خودش؛ یک انکود طولانی بقیه رو معطل نکنه
+        .post_init(open_download_client)
+        .post_shutdown(close_download_client)
         .build()
     )
 